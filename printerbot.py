@@ -1,12 +1,43 @@
 #!/usr/bin/python3
 
+import aiofiles
+import asyncio
+import atexit
+import cachetools
+import collections
+import contextlib
+import concurrent.futures
+import functools
+import hashlib
+import hmac
+import httpx
+import importlib.util
 import logging
+import logging.handlers
 import os
 import pathlib
+import queue
 import re
+import secrets
+import shutil
+import signal
+import sqlite3
+import string
+import cups
 import telegram
-import tempfile
+import threading
+import time
+from pypdf import PdfReader
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 from telegram import Update
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackContext, ContextTypes, CallbackQueryHandler
 
 # This is the Telegram Bot that prints all input documents. It uses libreoffice to convert non-pdf files
@@ -20,233 +51,994 @@ token_path = "./token"
 password_path = "./auth_password"                                                   #
 #####################################################################################
 
-token_key = open(token_path, "r").read().strip()
-password = open(password_path, "r").read().strip()
+token_key = pathlib.Path(token_path).read_text().strip()
+
+# Only the hash of the password is kept in memory. It is read once at start, SIGHUP makes the bot re-read it.
+def read_password_hash():
+    return hashlib.sha256(pathlib.Path(password_path).read_bytes().strip()).digest()
+password_hash = read_password_hash()  # fail early if the password file is missing
 
 # Safety measure. Files larger than this limit are not accepted
 file_size_limit = 64*1024*1024  # 64Mb
 
-# Directory where files for printing should be saved
+# Directory where files for printing should be saved. Every file is written once and then read back
+# for conversion, page counting and printing; on SD card or HDD hosts consider pointing this to a tmpfs,
+# e.g. "/dev/shm/printed_files", so none of that touches the disk.
 files_dir = "printed_files"
 pathlib.Path(files_dir).mkdir(parents=True, exist_ok=True)
+# Files are always referred to by absolute paths, as they are also handed to other processes (unoconvert)
+abs_files_dir = os.path.realpath(files_dir)
+
+# Chats that passed authentication are remembered here, so they don't have to re-authorize after a restart
+auth_db_path = "authorized_chats.db"
+
+# Number of connections to the Bot API used for sending replies and edits
+telegram_connection_pool_size = 32
+
+# Conversion to pdf is aborted if it takes longer than this
+conversion_timeout = 30  # seconds
 
+# LibreOffice is kept running in background by unoserver (if installed), so that conversions
+# don't pay LibreOffice start-up time. A single LibreOffice converts one file at a time, so several
+# of them are started, each with its own profile. Worker i listens on unoserver_port + 2*i,
+# its LibreOffice on uno_port + 2*i.
+unoserver_workers = 2
+unoserver_port = 2003
+uno_port = 2002
+unoserver_profile_dir = "/tmp/printerbot-lo-profile"
 
-# Configuring logging
+# Persistent IPP connections to the local cupsd, used for all printer queries and jobs.
+# CUPS calls block, so they run in worker threads, and a pycups connection must not be shared
+# between threads - hence one connection per thread.
+cups_local = threading.local()
+def cups_conn():
+    if not hasattr(cups_local, "conn"):
+        cups_local.conn = cups.Connection()
+    return cups_local.conn
+
+
+# Configuring logging. Handlers doing the actual I/O run in a separate thread fed through a queue,
+# so logging from handlers never blocks the event loop on disk or console writes.
 log_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
 
-file_handler = logging.FileHandler("printerbot.log")
+# Rotated so the log doesn't grow without bounds
+file_handler = logging.handlers.RotatingFileHandler("printerbot.log", maxBytes=10*1024*1024, backupCount=5, delay=True)
 file_handler.setFormatter(log_formatter)
-logger.addHandler(file_handler)
 
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(log_formatter)
-logger.addHandler(console_handler)
+
+log_queue = queue.SimpleQueue()
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger("printerbot")
 
 
+# Replies that never change
+auth_request_text = "Please authorize by \"/auth <password>\"."
+help_text = ("Send a document or an image to print it.\n\n"
+             "Available commands:\n"
+             "/start - Show printer status\n"
+             "/pending - Show pending jobs\n"
+             "/completed - Show last 10 completed jobs\n"
+             "/cancel <job_id> - Cancel a pending job")
+
 async def request_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Please authorize by \"/auth <password>\".")
+    await update.effective_message.reply_text(auth_request_text)
 
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("User {} /start request".format(update.message.from_user.username))
-    if not auth_passed(update):
-        return await request_auth(update, context)
+def require_auth(action):
+    """Logs the request and asks chats that haven't authorized yet to do so instead of running the handler."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            logger.info("User %s %s", update.effective_user.username, action)
+            if not auth_passed(update):
+                return await request_auth(update, context)
+            return await handler(update, context)
+        return wrapper
+    return decorator
+
+def rate_limit(per_user):
+    """Drops updates from a user coming less than per_user seconds after the previous accepted one.
+    Button clicks are limited per button, so clicking another button right away still works."""
+    def decorator(handler):
+        # Keys of recently accepted updates, they expire once the same update is allowed again
+        last_accepted = cachetools.TTLCache(maxsize=4096, ttl=per_user)
+
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            key = update.effective_user.id
+            if update.callback_query is not None:
+                key = (key, update.callback_query.data)
+            if key in last_accepted:
+                if update.callback_query is not None:
+                    await update.callback_query.answer(text="Too many clicks, please try again")
+                return
+            last_accepted[key] = True
+            return await handler(update, context)
+        return wrapper
+    return decorator
+
+
+printer_states = {cups.IPP_PRINTER_IDLE: "idle", cups.IPP_PRINTER_PROCESSING: "printing", cups.IPP_PRINTER_STOPPED: "stopped"}
+job_attributes = ["job-id", "job-name", "job-originating-user-name", "job-k-octets", "job-printer-uri", "time-at-creation"]
+
+def format_printers(printers):
+    lines = []
+    for name, attrs in printers.items():
+        line = "printer {} is {}.".format(name, printer_states.get(attrs.get("printer-state"), "unknown"))
+        if attrs.get("printer-state-message"):
+            line += " " + attrs["printer-state-message"]
+        lines.append(line)
+    return "\n".join(lines)
 
+def format_jobs(jobs):
+    # Mimics "lpstat -W" output: <printer>-<id> <user> <size> <date>
+    lines = []
+    for job_id, attrs in sorted(jobs.items()):
+        printer = attrs.get("job-printer-uri", "").rsplit('/', 1)[-1]
+        lines.append("{}-{} {} {}k {} {}".format(
+            printer, job_id, attrs.get("job-originating-user-name", ""), attrs.get("job-k-octets", 0),
+            time.ctime(attrs.get("time-at-creation", 0)), attrs.get("job-name", "")))
+    return "\n".join(lines)
+
+def get_printers():
+    return format_printers(cups_conn().getPrinters())
+
+def get_jobs(which_jobs, last=None):
+    jobs = cups_conn().getJobs(which_jobs=which_jobs, requested_attributes=job_attributes)
+    if last is not None:
+        jobs = dict(sorted(jobs.items())[-last:])
+    return format_jobs(jobs)
+
+async def get_printer_state():
+    # The queries are independent, so they run at the same time, each in its worker thread
+    # and over that thread's own connection
+    printers, pending, completed = await asyncio.gather(
+        asyncio.to_thread(get_printers),
+        asyncio.to_thread(get_jobs, 'not-completed'),
+        asyncio.to_thread(get_jobs, 'completed', 10))
+    return {'printers': printers, 'pending': pending, 'completed': completed}
+
+# Printer state as of the last poll. Handlers reply from here instead of querying CUPS every time.
+printer_state = {}
+printer_poll_interval = 2  # seconds
+
+async def refresh_printer_state():
+    try:
+        printer_state.update(await get_printer_state())
+    except (cups.IPPError, RuntimeError) as e:
+        logger.info("Failed to get printer state: %s", e)
+
+async def poll_printer_state():
+    while True:
+        await asyncio.sleep(printer_poll_interval)
+        await refresh_printer_state()
+
+def cancel_job(job_id):
+    cups_conn().cancelJob(job_id)
+
+
+@require_auth("/start request")
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = "You are authorized to print, just send a file here.\n"
-    msg += "Current state:\n" + os.popen('lpstat -p').read() + "\n"
-    msg += "Printer queue:\n" + os.popen('lpq').read()
+    msg += "Current state:\n" + printer_state.get('printers', '') + "\n"
+    msg += "Printer queue:\n" + (printer_state.get('pending') or "no entries")
     await update.message.reply_text(msg)
 
+@require_auth("/pending request")
 async def pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("User {} /pending request".format(update.message.from_user.username))
-    if not auth_passed(update):
-        return request_auth(update, context)
-
-    msg = os.popen('lpstat -W not-completed').read()
+    msg = printer_state.get('pending', '')
     if msg == '':
         msg = "No jobs found"
     await update.message.reply_text(msg)
 
+@require_auth("/completed request")
 async def completed(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("User {} /completed request".format(update.message.from_user.username))
-    if not auth_passed(update):
-        return await request_auth(update, context)
-
-    msg = os.popen('lpstat -W completed | head').read()
+    msg = printer_state.get('completed', '')
     if msg == '':
         msg = "No jobs found"
     await update.message.reply_text(msg)
 
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("User {} /cancel request".format(update.message.from_user.username))
-    if not auth_passed(update):
-        return await request_auth(update, context)
+job_id_chars = frozenset(string.ascii_letters + string.digits + '_-')
+job_id_max_length = 64
 
+@require_auth("/cancel request")
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     job_id = ''.join(context.args).strip()
-    if not re.match('^[a-zA-Z0-9_\-]+$', job_id):
+    if not job_id or len(job_id) > job_id_max_length or not job_id_chars.issuperset(job_id):
         await update.message.reply_text("Invalid job_id '{}'".format(job_id))
         return
-    logger.info("User {} cancel request, job '{}'".format(update.message.from_user.username, job_id))
-    os.system("cancel {}".format(job_id))
+    # Accept both plain ids and "<printer>-<id>" as shown by /pending
+    job_num = job_id.rsplit('-', 1)[-1]
+    if not job_num.isdigit():
+        await update.message.reply_text("Invalid job_id '{}'".format(job_id))
+        return
+    logger.info("User %s cancel request, job '%s'", update.message.from_user.username, job_id)
+    try:
+        await asyncio.to_thread(cancel_job, int(job_num))
+    except (cups.IPPError, RuntimeError) as e:
+        logger.info("Failed to cancel job '%s': %s", job_id, e)
+        await update.message.reply_text("Failed to cancel job '{}'".format(job_id))
+        return
     await update.message.reply_text("Cancel command complete")
+    # Don't let /pending show the cancelled job until the next poll
+    await refresh_printer_state()
+
+
+# Only the bot's user may read the list of authorized chats. sqlite creates its -wal/-shm files
+# with the same permissions as the database.
+pathlib.Path(auth_db_path).touch(mode=0o600)
+os.chmod(auth_db_path, 0o600)
+# Writes happen in worker threads, one at a time
+auth_db = sqlite3.connect(auth_db_path, check_same_thread=False)
+auth_db_lock = threading.Lock()
+auth_db.execute("PRAGMA journal_mode=WAL")
+auth_db.execute("CREATE TABLE IF NOT EXISTS auth (chat_id INTEGER PRIMARY KEY)")
+authorized_chats = set(chat_id for (chat_id,) in auth_db.execute("SELECT chat_id FROM auth"))
 
+def store_authorized_chat(chat_id):
+    with auth_db_lock:
+        auth_db.execute("INSERT OR IGNORE INTO auth (chat_id) VALUES (?)", (chat_id,))
+        auth_db.commit()
+
+async def add_authorized_chat(chat_id):
+    authorized_chats.add(chat_id)
+    await asyncio.to_thread(store_authorized_chat, chat_id)
 
-authorized_chats = set()
 def auth_passed(update):
-    return update.message.chat_id in authorized_chats
+    return update.effective_chat.id in authorized_chats
+
+
+async def update_message(context: CallbackContext, msg: telegram.Message, text, reply_markup=None):
+    await context.bot.edit_message_text(text, msg.chat.id, msg.message_id, reply_markup=reply_markup)
+
+# Intermediate statuses are only shown if they last at least this long
+status_update_delay = 0.4  # seconds
 
+class StatusMessage:
+    """Progress message that coalesces edits: an intermediate status is sent only after status_update_delay,
+    and is dropped if a newer status comes first. Final statuses are sent right away."""
 
-async def update_message(context: CallbackContext, msg: telegram.Message, text):
-    await context.bot.edit_message_text(text, msg.chat.id, msg.message_id)
+    def __init__(self, context: CallbackContext, msg: telegram.Message):
+        self.context = context
+        self.msg = msg
+        self.text = None
+        self.flush_task = None
+        self.sending = False
+
+    def set(self, text):
+        self.text = text
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(status_update_delay)
+        self.sending = True
+        text = self.text
+        try:
+            await update_message(self.context, self.msg, text)
+        except telegram.error.TelegramError as e:
+            logger.info("Failed to update status message: %s", e)
+        finally:
+            self.sending = False
+            self.flush_task = None
+        # A status set while the edit was on its way would be lost otherwise
+        if self.text != text:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    def discard(self):
+        """Drops an intermediate status that hasn't been sent yet."""
+        if self.flush_task is not None and not self.sending:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+    async def finish(self, text, reply_markup=None):
+        # An edit already on its way must land before the final one, otherwise it would overwrite it
+        if self.flush_task is not None and self.sending:
+            await self.flush_task
+        # That includes a follow-up edit it may have scheduled
+        self.discard()
+        await update_message(self.context, self.msg, text, reply_markup=reply_markup)
 
 async def authorize(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("User {} /authorize request".format(update.message.from_user.username))
+    logger.info("User %s /authorize request", update.message.from_user.username)
     args = ''.join(context.args)
 
     if auth_passed(update):
-        logger.info("User {} tried to authorize multiple times.".format(update.message.from_user.username))
+        logger.info("User %s tried to authorize multiple times.", update.message.from_user.username)
         await update.message.reply_text("You already authorized!")
         return
 
-    if password == args:
-        authorized_chats.add(update.effective_chat.id)
-        logger.info("User {} authorized.".format(update.message.from_user.username))
+    # Constant-time comparison, so response timing doesn't reveal how much of the password matched
+    if hmac.compare_digest(password_hash, hashlib.sha256(args.encode()).digest()):
+        await add_authorized_chat(update.effective_chat.id)
+        logger.info("User %s authorized.", update.message.from_user.username)
         await update.message.reply_text("Now you can print files via sending.")
     else:
-        logger.info("User {} entered wrong password: {}.".format(update.message.from_user.username, args))
+        logger.info("User %s entered wrong password: %s.", update.message.from_user.username, args)
         await update.message.reply_text("Wrong password!")
 
 
+class TokenBucket:
+    """Allows up to `capacity` actions at once, refilled at `rate` actions per second."""
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+# Limits protecting CUPS spool from being flooded: number of files sent to CUPS at the same time,
+# and per user, number of files sent for printing at once and how fast that allowance recovers
+concurrent_prints = 2
+print_burst = 10
+print_rate = 1/60  # files per second
+
+print_semaphore = asyncio.Semaphore(concurrent_prints)
+print_buckets = collections.defaultdict(lambda: TokenBucket(print_burst, print_rate))
+
+# Images CUPS prints by itself, without converting them to pdf first. They are always a single page.
+image_extensions = frozenset(('.jpg', '.jpeg', '.png', '.gif'))
+# Files with these extensions are sent to the printer as they are
+printable_extensions = image_extensions | {'.pdf'}
+
+def is_image(file_path):
+    return os.path.splitext(file_path)[1].lower() in image_extensions
+
 def cmd_print_file(file_path):
-    cmd = 'lpr "{}"'.format(file_path)
-    logger.info("Executing {}".format(cmd))
-    os.system(cmd)
+    conn = cups_conn()
+    printer = conn.getDefault()
+    if printer is None:
+        raise RuntimeError("no default printer is set")
+    options = {'fit-to-page': 'true'} if is_image(file_path) else {}
+    logger.info("Sending %s to printer %s", file_path, printer)
+    job_id = conn.printFile(printer, file_path, os.path.basename(file_path), options)
+    logger.info("Created print job %s", job_id)
+    drop_page_cache(file_path)
+
+def drop_page_cache(file_path):
+    # cupsd has its own copy of the file in the spool now, don't keep ours cached in memory
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    # The job is already queued, so failing here (e.g. the file was just deleted via another upload) doesn't matter
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.info("Failed to drop %s from the page cache: %s", file_path, e)
+
+async def run(*argv, timeout=None):
+    """Runs a command without a shell. Returns (returncode, stdout), returncode is None on timeout."""
+    proc = await asyncio.create_subprocess_exec(*argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        (out, _) = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return (None, '')
+    return (proc.returncode, out.decode(errors='replace'))
+
+async def wait_process(proc, timeout):
+    try:
+        return await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return None
+
+
+class UnoServer:
+    """Persistent LibreOffice instance driven through unoserver/unoconvert."""
+
+    def __init__(self, port, uno_port, profile_dir):
+        self.port = port
+        self.uno_port = uno_port
+        self.profile_dir = profile_dir
+        self.proc = None
+
+    def is_running(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self, startup_timeout=60):
+        logger.info("Starting unoserver on port %s", self.port)
+        self.proc = await asyncio.create_subprocess_exec(
+            'unoserver', '--interface', '127.0.0.1', '--port', str(self.port), '--uno-port', str(self.uno_port),
+            '--user-installation', os.path.abspath(self.profile_dir),
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+
+        # Wait until the server accepts connections
+        deadline = time.monotonic() + startup_timeout
+        while time.monotonic() < deadline and self.is_running():
+            try:
+                (_, writer) = await asyncio.open_connection('127.0.0.1', self.port)
+                writer.close()
+                await writer.wait_closed()
+                logger.info("unoserver on port %s is ready", self.port)
+                return True
+            except OSError:
+                await asyncio.sleep(0.5)
+        logger.info("unoserver on port %s failed to start", self.port)
+        await self.stop()
+        return False
 
-async def maybe_convert(context: CallbackContext, msg: telegram.Message, file_path):
-    (fpath, ext) = os.path.splitext(file_path);
-    if ext.lower() == ".pdf":
+    async def stop(self):
+        if self.is_running():
+            self.proc.terminate()
+            if await wait_process(self.proc, 10) is None:
+                logger.info("unoserver on port %s had to be killed", self.port)
+
+    async def restart(self):
+        await self.stop()
+        return await self.start()
+
+    async def convert(self, file_path, pdf_path):
+        """Returns whether the conversion succeeded, or None if the server couldn't be started."""
+        # Long-lived LibreOffice processes can die or wedge; bring them back before use
+        if not self.is_running() and not await self.restart():
+            return None
+
+        (returncode, _) = await run('unoconvert', '--port', str(self.port), '--convert-to', 'pdf', file_path, pdf_path,
+                                    timeout=conversion_timeout)
+        if returncode is None:
+            logger.info("Conversion of %s timed out, restarting unoserver", file_path)
+            await self.restart()
+            return False
+        return returncode == 0
+
+class UnoServerPool:
+    """Dispatches conversions to whichever UnoServer is idle."""
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.idle = asyncio.Queue()
+        self.waiting = 0
+        for server in servers:
+            self.idle.put_nowait(server)
+
+    def queue_position(self):
+        """Position a conversion started now would have in the queue, 0 if a server is free."""
+        return self.waiting + 1 if self.idle.empty() else 0
+
+    async def start(self):
+        await asyncio.gather(*(server.start() for server in self.servers))
+
+    async def stop(self):
+        await asyncio.gather(*(server.stop() for server in self.servers))
+
+    async def convert(self, file_path, pdf_path, on_start=None):
+        self.waiting += 1
+        try:
+            server = await self.idle.get()
+        finally:
+            self.waiting -= 1
+        if on_start is not None:
+            on_start()
+        try:
+            return await server.convert(file_path, pdf_path)
+        finally:
+            self.idle.put_nowait(server)
+
+uno_server = None
+if shutil.which('unoserver') and shutil.which('unoconvert'):
+    uno_server = UnoServerPool([
+        UnoServer(unoserver_port + 2*i, uno_port + 2*i, "{}-{}".format(unoserver_profile_dir, i))
+        for i in range(unoserver_workers)])
+
+
+libreoffice_semaphore = asyncio.Semaphore(1)
+
+async def convert_with_libreoffice(file_path):
+    (returncode, _) = await run('libreoffice', '--headless', '--convert-to', 'pdf', file_path, '--outdir', abs_files_dir,
+                                timeout=conversion_timeout)
+    if returncode is None:
+        logger.info("Conversion of %s timed out", file_path)
+    return returncode == 0
+
+async def maybe_convert(status: StatusMessage, file_path):
+    (fpath, ext) = os.path.splitext(os.path.basename(file_path))
+    if ext.lower() in printable_extensions:
         return (file_path, True)
 
-    await update_message(context, msg, "Converting to pdf...")
+    new_path = os.path.join(abs_files_dir, fpath + '.pdf')
+    success = None
+    if uno_server is not None:
+        position = uno_server.queue_position()
+        if position:
+            status.set("Queued for conversion (position {})...".format(position))
+        success = await uno_server.convert(file_path, new_path, on_start=lambda: status.set("Converting to pdf..."))
+        if success is None:
+            logger.info("unoserver is not available, converting %s with a one-shot libreoffice", file_path)
+    if success is None:
+        if libreoffice_semaphore.locked():
+            status.set("Queued for conversion...")
+        # One-shot LibreOffice instances share the default profile, which can't be used concurrently
+        async with libreoffice_semaphore:
+            status.set("Converting to pdf...")
+            success = await convert_with_libreoffice(file_path)
 
-    if 0 == os.system('timeout 30 libreoffice --convert-to "pdf" "{}" --outdir {}'.format(file_path, files_dir)):
-        new_path = files_dir + '/' + os.path.splitext(os.path.basename(file_path))[0] + '.pdf'
+    if success:
         return (new_path, True )
     else:
         return (file_path, False)
 
 def get_num_pages(file_path):
-    num_pages = os.popen('pdfinfo "{}" | grep Pages'.format(file_path)).read().strip()
-    return int(''.join(filter(str.isdigit, num_pages)))
+    # pikepdf (qpdf) only reads the xref and the page tree, which is much faster on big files
+    if pikepdf is not None:
+        with pikepdf.open(file_path) as pdf:
+            return len(pdf.pages)
+    return len(PdfReader(file_path, strict=False).pages)
+
+# Parsing a big PDF holds the GIL for a long time, so it is done in separate processes.
+# The pool is created in post_init, so that its workers don't re-run this module's start-up code.
+pdf_workers = 2
+pdf_pool = None
+# Malformed files can make the parsers hang
+page_count_timeout = 10  # seconds
+
+def start_pdf_pool():
+    global pdf_pool
+    pdf_pool = concurrent.futures.ProcessPoolExecutor(max_workers=pdf_workers)
+
+def stop_pdf_pool():
+    # A worker stuck on a file would never finish and ProcessPoolExecutor has no public way to stop it
+    for proc in list((getattr(pdf_pool, '_processes', None) or {}).values()):
+        proc.kill()
+    pdf_pool.shutdown(wait=False, cancel_futures=True)
+
+# Page counts keyed on (path, mtime, size), so a file replaced under the same name is re-read
+page_counts = cachetools.LRUCache(maxsize=256)
+
+pdfinfo_pages_re = re.compile(r'^Pages:\s*(\d+)', re.MULTILINE)
+
+async def count_pages(file_path):
+    st = os.stat(file_path)
+    key = (file_path, st.st_mtime_ns, st.st_size)
+    if key in page_counts:
+        return page_counts[key]
+    try:
+        num_pages = await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(pdf_pool, get_num_pages, file_path), page_count_timeout)
+        page_counts[key] = num_pages
+        return num_pages
+    except asyncio.TimeoutError:
+        logger.info("Reading %s timed out, restarting pdf workers and falling back to pdfinfo", file_path)
+        stop_pdf_pool()
+        start_pdf_pool()
+    except Exception as e:
+        # e.g. encrypted files, which poppler can still read
+        logger.info("Failed to read %s (%s), falling back to pdfinfo", file_path, e)
+
+    try:
+        (returncode, out) = await run('pdfinfo', file_path, timeout=10)
+    except FileNotFoundError:
+        # poppler is optional
+        return 0
+    match = pdfinfo_pages_re.search(out)
+    return int(match.group(1)) if match else 0
 
 def get_temp_name_for(file_name: str) -> str:
-    temp_name = next(tempfile._get_candidate_names())
+    _, ext = os.path.splitext(file_name)
+    return secrets.token_hex(8) + ext
+
+# Shared client for downloading uploaded files from Telegram. Connections are kept alive between
+# downloads. It stays on HTTP/1.1, so that parallel parts of a file get a connection each
+# instead of being multiplexed over one.
+http_client = httpx.AsyncClient(timeout=httpx.Timeout(10, connect=5, read=60),
+                                limits=httpx.Limits(max_keepalive_connections=32))
+
+# Files bigger than download_part_size are fetched as parts of this size, up to download_parts at a time
+download_part_size = 4*1024*1024
+download_parts = 4
+# Uploads start downloading as soon as they arrive, while earlier ones are still being converted,
+# but no more than this many files are downloaded at the same time
+max_parallel_downloads = 4
+download_semaphore = asyncio.Semaphore(max_parallel_downloads)
+# A part that fails with a network error, 429 or 5xx is retried this many times, resuming where it stopped,
+# after 1s, 2s, 4s... (or as long as the server's Retry-After asks, unless that's longer than
+# download_retry_max_delay - then the file is downloaded as a single stream instead)
+download_part_retries = 3
+download_retry_max_delay = 30  # seconds
+retryable_statuses = frozenset({429, 500, 502, 503, 504})
 
-    ext = ""
-    _, file_extension = os.path.splitext(file_name)
-    if file_extension:
-        ext = file_extension
+def remove_files(paths):
+    for path in paths:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
 
-    return temp_name+ext
+# Keeps fire-and-forget tasks referenced until they are done
+background_tasks = set()
+
+def remove_files_later(*paths):
+    # Deleting happens in a worker thread and nobody waits for it
+    task = asyncio.create_task(asyncio.to_thread(remove_files, set(paths)))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def download_stream(url, file_path):
+    # Stream the file to disk in chunks instead of writing it from the event loop in one go
+    async with http_client.stream('GET', url) as response:
+        response.raise_for_status()
+        async with aiofiles.open(file_path, 'wb') as f:
+            async for chunk in response.aiter_bytes(1024*1024):
+                await f.write(chunk)
+
+def retry_delay(error, attempt):
+    if isinstance(error, httpx.HTTPStatusError):
+        if error.response.status_code not in retryable_statuses:
+            return None
+        retry_after = error.response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            delay = int(retry_after)
+            return delay if delay <= download_retry_max_delay else None
+    return 2 ** attempt
+
+async def download_part(url, fd, offset, end, semaphore):
+    for attempt in range(download_part_retries + 1):
+        try:
+            async with semaphore:
+                headers = {'Range': 'bytes={}-{}'.format(offset, end - 1)}
+                async with http_client.stream('GET', url, headers=headers) as response:
+                    response.raise_for_status()
+                    if response.status_code != httpx.codes.PARTIAL_CONTENT:
+                        raise httpx.HTTPStatusError("Range requests are not supported",
+                                                    request=response.request, response=response)
+                    async for chunk in response.aiter_bytes(1024*1024):
+                        await asyncio.to_thread(os.pwrite, fd, chunk, offset)
+                        offset += len(chunk)
+            return
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt == download_part_retries:
+                raise
+            logger.info("Download of bytes %s-%s failed (%s), retrying in %ss", offset, end - 1, e, delay)
+        # Other parts can use the slot meanwhile
+        await asyncio.sleep(delay)
+
+async def download_parallel(url, file_path, size):
+    # Parts are written straight to their offsets in a preallocated file, so there's nothing to merge
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                pass
+        semaphore = asyncio.Semaphore(download_parts)
+        tasks = [asyncio.create_task(download_part(url, fd, offset, min(offset + download_part_size, size), semaphore))
+                 for offset in range(0, size, download_part_size)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    finally:
+        os.close(fd)
+
+async def download_file(new_file: telegram.File, file_path):
+    size = new_file.file_size
+    if size and size > download_part_size:
+        try:
+            return await download_parallel(new_file.file_path, file_path, size)
+        except httpx.HTTPError as e:
+            logger.info("Parallel download of %s failed (%s), downloading as a single stream", file_path, e)
+    await download_stream(new_file.file_path, file_path)
 
 async def text_callback(update: Update, context: CallbackContext):
-    await update.message.reply_text("Use commands")
+    await update.message.reply_text(help_text)
+
+def document_attachment(document: telegram.Document):
+    return (document, document.file_name)
 
+def photo_attachment(photo_sizes):
+    # The last size is the biggest one. Telegram sends photos as jpeg.
+    photo = photo_sizes[-1]
+    return (photo, photo.file_unique_id + '.jpg')
+
+# Message attributes that can carry a printable file, with functions returning (attachment, file_name) for them
+attachment_types = (
+    ('document', document_attachment),
+    ('photo', photo_attachment),
+)
+
+@require_auth("file upload")
 async def upload_file(update: Update, context: CallbackContext):
-    logger.info("User {} file upload".format(update.message.from_user.username))
-    if not auth_passed(update):
-        return await request_auth(update, context)
-    if update.message.document is not None:
-        file_id = update.message.document.file_id
-        file_size = update.message.document.file_size
-        file_name = update.message.document.file_name
-        new_file = await update.message.document.get_file()
-    elif update.message.photo is not None:
-        file_id = update.message.photo[-1].file_id
-        file_size = update.message.photo[-1].file_size
-        file_name = update.message.photo[-1].file_unique_id
-        new_file = await update.message.photo[-1].get_file()
+    for (attr, get_attachment) in attachment_types:
+        value = getattr(update.message, attr, None)
+        if value:
+            (attachment, file_name) = get_attachment(value)
+            break
     else:
         logger.info("Unknown message type")
         return
+    file_size = attachment.file_size
 
     if file_size > file_size_limit:
         await update.message.reply_text("File is too big ({} > {})!".format(file_size, file_size_limit))
         return
 
-    reply_msg = await update.message.reply_text("Downloading file...")
+    # The download starts right away. The rest is up to the chat's worker, which keeps uploads from one chat
+    # in order, so this file downloads while the ones sent before it are converted.
+    started = asyncio.Event()  # set once the worker gets to this upload
+    fetching = asyncio.create_task(fetch_upload(update, context, attachment, file_name, started))
+    chat_id = update.message.chat_id
+    if chat_id not in chat_uploads:
+        uploads = asyncio.Queue()
+        chat_uploads[chat_id] = (uploads, asyncio.create_task(upload_worker(chat_id, uploads)))
+    await chat_uploads[chat_id][0].put((update, context, attachment, file_name, fetching, started))
 
-    temp_name = get_temp_name_for(file_name)
-    file_path = files_dir + '/' + temp_name
 
-    logger.info("Downloading file {} from {}...".format(file_name, update.message.from_user.username))
-    await new_file.download_to_drive(custom_path=file_path)
-    logger.info("Downloaded file {} as {}".format(file_name, temp_name))
+# Per chat queue of uploads waiting to be processed and its worker task: chat_id -> (queue, task)
+chat_uploads = {}
 
-    (file_path, success) = await maybe_convert(context, reply_msg, file_path)
-    if not success:
-        update_message(context, reply_msg, "Failed to convert file {}, size {}!".format(file_name, file_size))
-        return
-    logger.info("Converted file {}".format(file_path))
+async def upload_worker(chat_id, uploads):
+    while True:
+        (update, context, attachment, file_name, fetching, started) = await uploads.get()
+        started.set()
+        try:
+            await process_upload(update, context, attachment, file_name, fetching)
+        except Exception:
+            logger.exception("Failed to process file %s", file_name)
+        # Worker goes away once the chat has nothing more queued
+        if uploads.empty():
+            del chat_uploads[chat_id]
+            return
+
+async def fetch_upload(update: Update, context: CallbackContext, attachment, file_name, started: asyncio.Event):
+    """Downloads the upload unless it was processed before. Returns (status, file_path, num_pages),
+    num_pages is None if the file still has to be converted and counted. Returns None if the download failed."""
+    # The same file uploaded again has the same file_unique_id, reuse the result of the previous upload
+    cached = converted_files.get(attachment.file_unique_id)
+    if cached is not None and os.path.isfile(cached[0]):
+        logger.info("File %s was already converted to %s", file_name, cached[0])
+        return (None, *cached)
 
-    # Delete upload status message after successful upload and convert
-    context.bot.delete_message(reply_msg.chat.id, reply_msg.message_id)
+    status = StatusMessage(context, await update.message.reply_text("Downloading file..."))
 
-    num_pages = get_num_pages(file_path)
-    logger.info("number of pages: {}".format(num_pages))
+    # Reserve the name right away, so nothing else can take it before the download creates the file
+    while True:
+        temp_name = get_temp_name_for(file_name)
+        file_path = os.path.join(abs_files_dir, temp_name)
+        try:
+            os.close(os.open(file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+            break
+        except FileExistsError:
+            pass
+
+    try:
+        new_file = await attachment.get_file()
+        async with download_semaphore:
+            logger.info("Downloading file %s from %s...", file_name, update.message.from_user.username)
+            await download_file(new_file, file_path)
+    except (telegram.error.TelegramError, httpx.HTTPError, OSError) as e:
+        logger.info("Failed to download file %s: %s", file_name, e)
+        remove_files_later(file_path)
+        await status.finish("Failed to download file {}!".format(file_name))
+        return None
+    logger.info("Downloaded file %s as %s", file_name, temp_name)
+    if not started.is_set():
+        status.set("Waiting for the files sent before it...")
+    return (status, file_path, None)
+
+async def process_upload(update: Update, context: CallbackContext, attachment, file_name, fetching):
+    file_size = attachment.file_size
+
+    fetched = await fetching
+    if fetched is None:
+        return
+    (status, file_path, num_pages) = fetched
+    if num_pages is None:
+        # The worker got here before the waiting status was shown, it's out of date already
+        status.discard()
+        downloaded_path = file_path
+        (file_path, success) = await maybe_convert(status, file_path)
+        if not success:
+            remove_files_later(downloaded_path)
+            await status.finish("Failed to convert file {}, size {}!".format(file_name, file_size))
+            return
+        logger.info("Converted file %s", file_path)
+        # Only the pdf is needed from now on (no-op if the upload was printable as is)
+        if file_path != downloaded_path:
+            remove_files_later(downloaded_path)
 
+        num_pages = 1 if is_image(file_path) else await count_pages(file_path)
+        logger.info("number of pages: %s", num_pages)
+        converted_files[attachment.file_unique_id] = (file_path, num_pages)
+
+    # Buttons only carry a short token, the file itself is looked up in pending_files
+    token = secrets.token_urlsafe(8)
+    pending_files[token] = (file_path, num_pages)
     keyboard = [
-        [telegram.InlineKeyboardButton("Print", callback_data="print {}".format(file_path))],
-        [telegram.InlineKeyboardButton("Delete file", callback_data="delete {}".format(file_path))],
+        [telegram.InlineKeyboardButton("Print", callback_data="p:{}".format(token))],
+        [telegram.InlineKeyboardButton("Delete file", callback_data="d:{}".format(token))],
     ]
     reply_markup = telegram.InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text("Num pages: {}".format(num_pages), reply_markup=reply_markup)
+    # The status message itself becomes the result, saving a delete and a send
+    text = "Num pages: {}".format(num_pages)
+    if status is None:
+        await update.message.reply_text(text, reply_markup=reply_markup)
+    else:
+        await status.finish(text, reply_markup=reply_markup)
+
+
+def release_file(file_path):
+    """Deletes a file once no button and no cached upload refers to it anymore."""
+    for cache in (pending_files, converted_files):
+        if any(path == file_path for (path, _) in cache.values()):
+            return
+    remove_files_later(file_path)
+
+def release_file_soon(file_path):
+    # Evictions happen in the middle of inserting a new entry, which may be for the same file
+    asyncio.get_running_loop().call_soon(release_file, file_path)
+
+class FileTTLCache(cachetools.TTLCache):
+    """TTLCache of (file_path, ...) values, deleting the files of expired and evicted entries."""
+
+    def popitem(self):
+        (key, value) = super().popitem()
+        release_file_soon(value[0])
+        return (key, value)
 
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for (_, value) in expired:
+            release_file_soon(value[0])
+        return expired
 
-def check_file(file_path):
-    return file_path == files_dir + '/' + os.path.basename(file_path)
+class FileLRUCache(cachetools.LRUCache):
+    """LRUCache of (file_path, ...) values, deleting the files of evicted entries."""
 
+    def popitem(self):
+        (key, value) = super().popitem()
+        release_file_soon(value[0])
+        return (key, value)
+
+# Uploaded files waiting for the user to press Print or Delete: token -> (file_path, num_pages)
+pending_files = FileTTLCache(maxsize=1024, ttl=3600)
+
+# Results of previous uploads: Telegram file_unique_id -> (file_path, num_pages)
+converted_files = FileLRUCache(maxsize=256)
+
+# Repeated clicks on the same button, e.g. on a slow connection, are answered without going through the handler
+@rate_limit(per_user=1.0)
+@require_auth("button click")
 async def button(update: Update, context: CallbackContext):
     query = update.callback_query
-    logger.info("User {} clicked button: ".format(query.data))
-    if not auth_passed(query):
-        return await request_auth(update, context)
+    logger.info("User %s clicked button: %s", query.from_user.username, query.data)
 
     # CallbackQueries need to be answered, even if no notification to the user is needed
     # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
     await query.answer()
 
-    (cmd, file_path) = query.data.split(' ', 1)
-    if not check_file(file_path):
+    # Buttons of messages sent by older versions of the bot have no ':' and end up as unknown tokens
+    (cmd, _, token) = query.data.partition(':')
+
+    # Tokens are one-shot, both buttons go away once either of them is used
+    pending = pending_files.pop(token, None)
+    # Files are shared between uploads of the same document, it could have been deleted via another one
+    if pending is None or not os.path.isfile(pending[0]):
+        await update_message(context, query.message, "File is no longer available, please send it again")
         return
+    (file_path, num_pages) = pending
 
-    if cmd == 'delete':
-        os.unlink(file_path)
+    if cmd == 'p' and not print_buckets[query.from_user.id].consume():
+        logger.info("User %s hit the print rate limit", query.from_user.username)
+        # Keep the file printable once the limit allows it again
+        pending_files[token] = pending
+        await query.message.reply_text("Too many files sent for printing, please try again later")
+        return
+
+    if cmd == 'd':
+        remove_files_later(file_path)
         await update_message(context, query.message, "Deleted")
-    elif cmd == 'print':
-        await print_file(context, query.message, file_path)
+    elif cmd == 'p':
+        await print_file(context, query.message, token, file_path, num_pages)
     else:
         await update_message(context, query.message, f"WAT?")
 
 
-async def print_file(context: CallbackContext, msg: telegram.Message, file_path):
-    num_pages = get_num_pages(file_path)
-    logger.info("Printing file {}. Number of pages: {}".format(file_path, num_pages))
-    cmd_print_file(file_path)
+async def print_file(context: CallbackContext, msg: telegram.Message, token, file_path, num_pages):
+    logger.info("Printing file %s. Number of pages: %s", file_path, num_pages)
+    try:
+        async with print_semaphore:
+            await asyncio.to_thread(cmd_print_file, file_path)
+    except (cups.IPPError, RuntimeError) as e:
+        logger.info("Failed to print file %s: %s", file_path, e)
+        # Give the token back and keep the buttons, so printing can be retried
+        pending_files[token] = (file_path, num_pages)
+        await update_message(context, msg, "Failed to send the file for printing, please try again",
+                             reply_markup=msg.reply_markup)
+        return
     await update_message(context, msg, "File was sent for printing!")
+    release_file(file_path)
+    # Make the new job show up in /pending right away rather than on the next poll
+    await refresh_printer_state()
+
+printer_poller = None
+
+def reload_password():
+    global password_hash
+    # Read right away, so a broken password file shows up now and the old password keeps working meanwhile
+    try:
+        password_hash = read_password_hash()
+    except OSError as e:
+        logger.error("Failed to reload password from %s, keeping the old one: %s", password_path, e)
+        return
+    logger.info("Reloaded password from %s", password_path)
+
+# Threads for blocking calls (CUPS, file writes, sqlite). A fixed pool keeps the thread count
+# (and the number of per-thread CUPS connections) bounded under bursts of uploads.
+io_threads = 8
+io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='printerbot-io')
+
+async def post_init(application: Application):
+    global printer_poller
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(io_executor)
+    loop.add_signal_handler(signal.SIGHUP, reload_password)
+    start_pdf_pool()
+    # Buttons of files left over from a previous run don't work anymore, nothing can use them
+    remove_files_later(*(entry.path for entry in os.scandir(abs_files_dir) if entry.is_file()))
+    await refresh_printer_state()
+    printer_poller = asyncio.create_task(poll_printer_state())
+    if uno_server is not None:
+        await uno_server.start()
+
+async def post_shutdown(application: Application):
+    if pdf_pool is not None:
+        stop_pdf_pool()
+    if printer_poller is not None:
+        printer_poller.cancel()
+    await http_client.aclose()
+    if uno_server is not None:
+        await uno_server.stop()
+    io_executor.shutdown(wait=True)
 
 
 def main() -> None:
-    application = Application.builder().token(token_key).build()
+    # libuv based event loop, cheaper per callback than the default asyncio loop. Not available on Windows.
+    if uvloop is not None:
+        uvloop.install()
+
+    # Process updates concurrently so that a long download or conversion for one user
+    # doesn't hold up commands and uploads from everybody else
+    # Bot API calls from concurrently running handlers share a pool of kept-alive connections
+    # (HTTP/2 if httpx has its h2 extra installed), instead of waiting for one of the default few.
+    # A call that can't get a connection from the pool within a few seconds fails instead of hanging.
+    http_version = '2' if importlib.util.find_spec('h2') else '1.1'
+    request = HTTPXRequest(connection_pool_size=telegram_connection_pool_size, connect_timeout=5, read_timeout=20,
+                           pool_timeout=5, http_version=http_version)
+    application = (Application.builder().token(token_key).request(request).concurrent_updates(True)
+                   .post_init(post_init).post_shutdown(post_shutdown).build())
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("auth", authorize))
     application.add_handler(CommandHandler("pending", pending))
     application.add_handler(CommandHandler("completed", completed))
     application.add_handler(CommandHandler("cancel", cancel))
-    application.add_handler(MessageHandler(filters=telegram.ext.filters.Document.ALL, callback=upload_file))
+    application.add_handler(MessageHandler(filters=telegram.ext.filters.Document.ALL | telegram.ext.filters.PHOTO,
+                                           callback=upload_file))
     application.add_handler(CallbackQueryHandler(button))
     application.add_handler(MessageHandler(filters=telegram.ext.filters.TEXT, callback=text_callback))
 